@@ -17,11 +17,12 @@ def cli():
 @click.option('--metrics', help='metrics file')
 @click.option('--tempdir', help='temporary directory')
 @click.option('--ncores', type=int, help='number of cores')
+@click.option('--run_igvtools', is_flag=True, help='generate igvtools tdf counts for merged bams')
 def merge_cells(infiles, cell_ids, reference, control_outfile, contaminated_outfile, pass_outfile, metrics, tempdir,
-                ncores):
+                ncores, run_igvtools):
     mondrianutils.alignment.merge_cells_by_type(
         infiles, reference, cell_ids, metrics, control_outfile, contaminated_outfile, pass_outfile, tempdir,
-        ncores
+        ncores, run_igvtools=run_igvtools
     )
 
 
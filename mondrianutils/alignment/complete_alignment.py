@@ -20,7 +20,6 @@ from mondrianutils.alignment import flagstat
 from mondrianutils.alignment import gc_metrics
 from mondrianutils.alignment import tss_enrichment
 import pysam
-import subprocess
 
 
 def load_metadata(metadata_yaml, lane_id, flowcell_id, cell_id):
@@ -90,15 +89,8 @@ def add_cell_id_to_header(bamfile, cellid, outputbam, tempdir):
     helpers.makedirs(tempdir)
     new_header = os.path.join(tempdir, 'header.sam')
 
-    subprocess.run(['samtools', 'view', '-H', bamfile, '-o', new_header])
-    with open(new_header, 'at') as header:
-        header.write('@CO\tCB:{}\n'.format(cellid))
-
-    subprocess.run(
-        ['picard', 'ReplaceSamHeader', 'I={}'.format(bamfile),
-         'HEADER={}'.format(new_header), 'O={}'.format(outputbam)
-         ]
-    )
+    alignment_utils.get_new_header([cellid], bamfile, new_header)
+    alignment_utils.reheader(bamfile, new_header, outputbam)
 
 
 def alignment(
@@ -173,7 +165,7 @@ def alignment(
         helpers.makedirs(os.path.join(lane_tempdir, 'tagging'))
         lane_tagged_bam = os.path.join(lane_tempdir, 'tagging', 'tagged.bam')
         alignment_utils.tag_bam_with_cellid(
-            lane_aligned_bam, lane_tagged_bam, cell_id
+            lane_aligned_bam, lane_tagged_bam, cell_id, ncores=num_threads
         )
 
         print("Starting Bam Sort")
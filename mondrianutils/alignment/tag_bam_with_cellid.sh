@@ -0,0 +1,11 @@
+#!/bin/bash
+set -eo pipefail
+
+INFILE=$1
+OUTFILE=$2
+CELL=$3
+THREADS=${4:-1}
+
+samtools view -h --no-PG "${INFILE}" \
+| awk -v cb="${CELL}" 'BEGIN{FS=OFS="\t"} /^@/{print;next}{print $0,"CB:Z:"cb}' \
+| samtools view --no-PG -b -@ "${THREADS}" -o "${OUTFILE}" -
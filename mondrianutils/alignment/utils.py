@@ -1,15 +1,28 @@
+import copy
+import functools
 import json
 import os
-import subprocess
-from collections import defaultdict
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
 
 import csverve.api as csverve
 import mondrianutils.helpers as helpers
+import numpy as np
+import pandas as pd
 import pysam
 import yaml
 from mondrianutils import __version__
 from mondrianutils.dtypes.alignment import dtypes
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+YamlDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
 
 class MultipleSamplesPerRun(Exception):
     pass
@@ -38,31 +51,41 @@ def _check_metadata_required_field(meta_data, field_name):
 
 
 def _check_lanes_and_flowcells(meta_data, input_data):
-    lane_data = defaultdict(set)
-
-    for val in input_data:
-        for lane in val['lanes']:
-            lane_data[lane['flowcell_id']].add(lane['lane_id'])
-
-    for flowcell, lanes in lane_data.items():
-        if flowcell not in meta_data['lanes']:
-            raise MissingField(
-                f'missing flowcell {flowcell} in metadata yaml'
-            )
-        for lane_id in lanes:
-            if lane_id not in meta_data['lanes'][flowcell]:
-                raise MissingField(
-                    f'missing lane {lane_id} for flowcell {flowcell} in metadata yaml'
-                )
+    required = {(lane['flowcell_id'], lane['lane_id']) for val in input_data for lane in val['lanes']}
+    provided = {(flowcell, lane_id) for flowcell, lanes in meta_data['lanes'].items() for lane_id in lanes}
+
+    missing = required - provided
+    if missing:
+        missing = ', '.join(f'lane {lane_id} for flowcell {flowcell}' for flowcell, lane_id in sorted(missing, key=str))
+        raise MissingField(
+            f'missing {missing} in metadata yaml'
+        )
+
+
+@functools.lru_cache(maxsize=16)
+def _load_yaml_cached(filepath, mtime):
+    with open(filepath, 'rt') as reader:
+        return yaml.load(reader, Loader=YamlLoader)
+
+
+def _load_yaml(filepath):
+    # callers are free to modify the returned data
+    return copy.deepcopy(_load_yaml_cached(filepath, os.path.getmtime(filepath)))
+
+
+def _load_json(filepath):
+    if orjson is None:
+        with open(filepath, 'rt') as reader:
+            return json.load(reader)
+
+    with open(filepath, 'rb') as reader:
+        return orjson.loads(reader.read())
 
 
 def input_validation(meta_yaml, input_json):
-    with open(meta_yaml, 'rt') as reader:
-        meta_data = yaml.safe_load(reader)
-        meta_data = meta_data['meta']
+    meta_data = _load_yaml(meta_yaml)['meta']
 
-    with open(input_json, 'rt') as reader:
-        input_data = json.load(reader)
+    input_data = _load_json(input_json)
 
     _check_metadata_required_field(meta_data, 'is_control')
     _check_metadata_required_field(meta_data, 'library_id')
@@ -84,56 +107,59 @@ def input_validation(meta_yaml, input_json):
 
 
 def get_new_header(cells, bamfile, new_header):
-    subprocess.run(['samtools', 'view', '-H', bamfile, '-o', new_header])
-    with open(new_header, 'at') as header:
-        for cell in cells:
-            header.write('@CO\tCB:{}\n'.format(cell))
+    with pysam.AlignmentFile(bamfile, 'rb') as reader:
+        header = str(reader.header)
 
+    if not header.endswith('\n'):
+        header += '\n'
 
-def reheader(infile, new_header, outfile):
-    subprocess.run(
-        ['picard', 'ReplaceSamHeader', 'I={}'.format(infile),
-         'HEADER={}'.format(new_header), 'O={}'.format(outfile)
-         ]
-    )
+    header += ''.join('@CO\tCB:{}\n'.format(cell) for cell in cells)
 
+    with open(new_header, 'wt') as writer:
+        writer.write(header)
 
-def get_pass_files(infiles, cell_ids, metrics):
-    metrics = csverve.read_csv(metrics)
-    assert set(cell_ids) == set(list(metrics['cell_id']))
 
-    cells_to_skip = set(list(metrics[metrics['is_contaminated']]['cell_id']))
-    infiles = {cell: infile for cell, infile in zip(cell_ids, infiles) if cell not in cells_to_skip}
+def reheader(infile, new_header, outfile):
+    # samtools only supports --in-place for cram, write to a temp file
+    # and move it over the input when reheadering a bam in place
+    if os.path.abspath(infile) == os.path.abspath(outfile):
+        temp_outfile = outfile + '.tmp'
+        helpers.run_cmd(['samtools', 'reheader', new_header, infile], output=temp_outfile)
+        os.replace(temp_outfile, outfile)
+    else:
+        helpers.run_cmd(['samtools', 'reheader', new_header, infile], output=outfile)
 
-    cells_to_skip = set(list(metrics[metrics['is_control']]['cell_id']))
-    infiles = {cell: infile for cell, infile in infiles.items() if cell not in cells_to_skip}
 
-    return infiles
+def get_cell_flags(metrics):
+    return dict(zip(metrics['cell_id'], zip(metrics['is_control'], metrics['is_contaminated'])))
 
 
-def get_control_files(infiles, cell_ids, metrics):
-    metrics = csverve.read_csv(metrics)
-    assert set(cell_ids) == set(list(metrics['cell_id']))
-    control_cells = set(list(metrics[metrics['is_control'] == True]['cell_id']))
-    infiles = {cell: infile for cell, infile in zip(cell_ids, infiles) if cell in control_cells}
-    return infiles
+def get_pass_files(infiles, cell_ids, cell_flags):
+    assert set(cell_ids) == cell_flags.keys()
+
+    return {
+        cell: infile for cell, infile in zip(cell_ids, infiles)
+        if not cell_flags[cell][0] and not cell_flags[cell][1]
+    }
 
 
-def get_contaminated_files(infiles, cell_ids, metrics):
-    metrics = csverve.read_csv(metrics)
-    assert set(cell_ids) == set(list(metrics['cell_id']))
+def get_control_files(infiles, cell_ids, cell_flags):
+    assert set(cell_ids) == cell_flags.keys()
 
-    cells_to_skip = set(list(metrics[metrics['is_control']]['cell_id']))
-    infiles = {cell: infile for cell, infile in zip(cell_ids, infiles) if cell not in cells_to_skip}
+    return {cell: infile for cell, infile in zip(cell_ids, infiles) if cell_flags[cell][0]}
 
-    contaminated_cells = set(list(metrics[metrics['is_contaminated']]['cell_id']))
-    infiles = {cell: infile for cell, infile in infiles.items() if cell in contaminated_cells}
 
-    return infiles
+def get_contaminated_files(infiles, cell_ids, cell_flags):
+    assert set(cell_ids) == cell_flags.keys()
+
+    return {
+        cell: infile for cell, infile in zip(cell_ids, infiles)
+        if not cell_flags[cell][0] and cell_flags[cell][1]
+    }
 
 
-def samtools_index(infile):
-    cmd = ['samtools', 'index', infile]
+def samtools_index(infile, ncores=1):
+    cmd = ['samtools', 'index', '-@', str(ncores), infile]
     helpers.run_cmd(cmd)
 
 
@@ -142,21 +168,23 @@ def igvtools_count(infile, reference):
     helpers.run_cmd(cmd)
 
 
-def merge_bams(infiles, tempdir, ncores, outfile, reference, empty_bam_content):
+def merge_bams(infiles, tempdir, ncores, outfile, reference, empty_bam_content, run_igvtools=False):
     if len(infiles.values()) == 0:
+        # header only bam, index in process and skip the merge
         pysam.AlignmentFile(outfile, "wb", header=empty_bam_content).close()
+        pysam.index(outfile)
     else:
         helpers.merge_bams(list(infiles.values()), outfile, tempdir, ncores)
+        samtools_index(outfile, ncores=ncores)
 
-    samtools_index(outfile)
-    igvtools_count(outfile, reference)
+    # igvtools is single threaded java, only run when tdf output is requested
+    if run_igvtools:
+        igvtools_count(outfile, reference)
 
 
 def get_bam_header(bam):
-    infile = pysam.AlignmentFile(bam, "rb")
-
-    header = infile.header
-
+    with pysam.AlignmentFile(bam, "rb", check_sq=False) as infile:
+        header = infile.header
 
     return header
 
@@ -164,90 +192,107 @@ def get_bam_header(bam):
 def merge_cells_by_type(
         infiles, reference, cell_ids, metrics,
         control_outfile, contaminated_outfile, pass_outfile,
-        tempdir, ncores
+        tempdir, ncores, run_igvtools=False
 ):
     header = get_bam_header(infiles[0])
-    # controls
-    control_bams = get_control_files(infiles, cell_ids, metrics)
-    control_tempdir = os.path.join(tempdir, 'control')
-    helpers.makedirs(control_tempdir)
-    merge_bams(control_bams, control_tempdir, ncores, control_outfile, reference, header)
+    cell_flags = get_cell_flags(csverve.read_csv(metrics))
+
+    groups = [
+        (get_control_files(infiles, cell_ids, cell_flags), 'control', control_outfile),
+        (get_contaminated_files(infiles, cell_ids, cell_flags), 'contaminated', contaminated_outfile),
+        (get_pass_files(infiles, cell_ids, cell_flags), 'pass', pass_outfile),
+    ]
+
+    # merges run as external processes, split the cores between the groups
+    # in proportion to their cell counts so the pass group isn't starved
+    total_cells = max(1, sum(len(group_bams) for group_bams, _, _ in groups))
 
-    # contaminated
-    contaminated_bams = get_contaminated_files(infiles, cell_ids, metrics)
-    contaminated_tempdir = os.path.join(tempdir, 'contaminated')
-    helpers.makedirs(contaminated_tempdir)
-    merge_bams(contaminated_bams, contaminated_tempdir, ncores, contaminated_outfile, reference, header)
+    with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+        futures = []
+        for group_bams, group_name, group_outfile in groups:
+            group_ncores = max(1, round(ncores * len(group_bams) / total_cells))
+            group_tempdir = os.path.join(tempdir, group_name)
+            helpers.makedirs(group_tempdir)
+            futures.append(executor.submit(
+                merge_bams, group_bams, group_tempdir, group_ncores, group_outfile, reference, header,
+                run_igvtools=run_igvtools
+            ))
 
-    # pass
-    pass_bams = get_pass_files(infiles, cell_ids, metrics)
-    pass_tempdir = os.path.join(tempdir, 'pass')
-    helpers.makedirs(pass_tempdir)
-    merge_bams(pass_bams, pass_tempdir, ncores, pass_outfile, reference, header)
+        for future in futures:
+            future.result()
 
 
-def tag_bam_with_cellid(infile, outfile, cell_id):
-    infile = pysam.AlignmentFile(infile, "rb")
-    outfile = pysam.AlignmentFile(outfile, "wb", template=infile)
+def tag_bam_with_cellid(infile, outfile, cell_id, ncores=1):
+    script_path = pathlib.Path(__file__).parent.resolve()
+    script_path = os.path.join(script_path, 'tag_bam_with_cellid.sh')
+    helpers.run_cmd([script_path, infile, outfile, cell_id, ncores])
 
-    iter = infile.fetch(until_eof=True)
-    for read in iter:
-        read.set_tag('CB', cell_id, replace=False)
-        outfile.write(read)
-    infile.close()
-    outfile.close()
+
+def get_fastqscreen_genomes(columns):
+    return list(_get_fastqscreen_genomes(tuple(columns)))
+
+
+@functools.lru_cache(maxsize=None)
+def _get_fastqscreen_genomes(columns):
+    genomes = {v.split('_')[1] for v in columns if v.startswith('fastqscreen_')}
+    return tuple(sorted(genomes - {'nohit', 'total'}))
 
 
 def add_contamination_status(
         infile, outfile,
         reference, threshold=0.05
 ):
-    def get_col_data(df, organism):
-        return df['fastqscreen_{}'.format(organism)] - df['fastqscreen_{}_multihit'.format(organism)]
-
     data = csverve.read_csv(infile)
 
     data = data.set_index('cell_id', drop=False)
 
-    organisms = [v for v in data.columns.values if v.startswith('fastqscreen_')]
-    organisms = sorted(set([v.split('_')[1] for v in organisms]))
-    organisms = [v for v in organisms if v not in ['nohit', 'total']]
+    organisms = get_fastqscreen_genomes(data.columns)
 
     if reference not in organisms:
         raise Exception("Could not find the fastq screen counts")
 
     alts = [col for col in organisms if not col == reference]
 
-    data['is_contaminated'] = False
-
-    for altcol in alts:
-        perc_alt = get_col_data(data, altcol) / data['fastqscreen_total_reads']
-        data.loc[perc_alt > threshold, 'is_contaminated'] = True
+    if len(alts) == 0:
+        data['is_contaminated'] = False
+    else:
+        alt_counts = np.column_stack([
+            data['fastqscreen_{}'.format(alt)].values - data['fastqscreen_{}_multihit'.format(alt)].values
+            for alt in alts
+        ])
+        ratios = alt_counts / data['fastqscreen_total_reads'].values[:, None]
+        data['is_contaminated'] = (ratios > threshold).any(axis=1)
 
-    col_type = dtypes()['metrics']['is_contaminated']
+    metrics_dtypes = dtypes(fastqscreen_genomes=organisms)['metrics']
 
-    data['is_contaminated'] = data['is_contaminated'].astype(col_type)
+    data['is_contaminated'] = data['is_contaminated'].astype(metrics_dtypes['is_contaminated'])
     csverve.write_dataframe_to_csv_and_yaml(
-        data, outfile, dtypes(fastqscreen_genomes=organisms)['metrics']
+        data, outfile, metrics_dtypes
     )
 
 
 def add_metadata(metrics, metadata_yaml, output):
     df = csverve.read_csv(metrics)
 
-    metadata = yaml.safe_load(open(metadata_yaml, 'rt'))
+    metadata = _load_yaml(metadata_yaml)
 
     cells = set(df['cell_id'])
 
     metadata['meta']['cells'] = {k: v for k, v in metadata['meta']['cells'].items() if k in cells}
 
-    for cellid, cell_info in metadata['meta']['cells'].items():
-        for colname, val in cell_info.items():
-            df.loc[df['cell_id'] == cellid, colname] = val
+    if len(metadata['meta']['cells']) > 0:
+        meta_df = pd.DataFrame.from_dict(metadata['meta']['cells'], orient='index')
+        # one metadata row per metrics row, NaN for cells without metadata
+        meta_df = meta_df.reindex(df['cell_id']).set_axis(df.index)
 
-    organisms = [v for v in df.columns.values if v.startswith('fastqscreen_')]
-    organisms = sorted(set([v.split('_')[1] for v in organisms]))
-    organisms = [v for v in organisms if v not in ['nohit', 'total']]
+        for colname in meta_df.columns:
+            if colname in df.columns:
+                # metadata values take precedence, other cells keep their values
+                df[colname] = meta_df[colname].combine_first(df[colname])
+            else:
+                df[colname] = meta_df[colname]
+
+    organisms = get_fastqscreen_genomes(df.columns)
 
     csverve.write_dataframe_to_csv_and_yaml(
         df, output,
@@ -259,8 +304,7 @@ def generate_metadata(
         bam, control, contaminated, metrics, gc_metrics,
         tarfile, metadata_input, metadata_output
 ):
-    with open(metadata_input, 'rt') as reader:
-        data = yaml.safe_load(reader)
+    data = _load_yaml(metadata_input)
 
     lane_data = data['meta']['lanes']
 
@@ -272,52 +316,24 @@ def generate_metadata(
         samples.add(data['meta']['cells'][cell]['sample_id'])
         libraries.add(data['meta']['cells'][cell]['library_id'])
 
+    files = [
+        (metrics[0], {'result_type': 'alignment_metrics'}),
+        (metrics[1], {'result_type': 'alignment_metrics'}),
+        (gc_metrics[0], {'result_type': 'alignment_gc_metrics'}),
+        (gc_metrics[1], {'result_type': 'alignment_gc_metrics'}),
+        (bam[0], {'result_type': 'merged_cells_bam', 'filtering': 'passed'}),
+        (bam[1], {'result_type': 'merged_cells_bam', 'filtering': 'passed'}),
+        (control[0], {'result_type': 'merged_cells_bam', 'filtering': 'control'}),
+        (control[1], {'result_type': 'merged_cells_bam', 'filtering': 'control'}),
+        (contaminated[0], {'result_type': 'merged_cells_bam', 'filtering': 'contaminated'}),
+        (contaminated[1], {'result_type': 'merged_cells_bam', 'filtering': 'contaminated'}),
+        (tarfile, {'result_type': 'alignment_metrics_plots'}),
+    ]
+
     data = dict()
     data['files'] = {
-        os.path.basename(metrics[0]): {
-            'result_type': 'alignment_metrics',
-            'auxiliary': helpers.get_auxiliary_files(metrics[0])
-        },
-        os.path.basename(metrics[1]): {
-            'result_type': 'alignment_metrics',
-            'auxiliary': helpers.get_auxiliary_files(metrics[1])
-        },
-        os.path.basename(gc_metrics[0]): {
-            'result_type': 'alignment_gc_metrics',
-            'auxiliary': helpers.get_auxiliary_files(gc_metrics[0])
-        },
-        os.path.basename(gc_metrics[1]): {
-            'result_type': 'alignment_gc_metrics',
-            'auxiliary': helpers.get_auxiliary_files(gc_metrics[1])
-        },
-        os.path.basename(bam[0]): {
-            'result_type': 'merged_cells_bam', 'filtering': 'passed',
-            'auxiliary': helpers.get_auxiliary_files(bam[0])
-        },
-        os.path.basename(bam[1]): {
-            'result_type': 'merged_cells_bam', 'filtering': 'passed',
-            'auxiliary': helpers.get_auxiliary_files(bam[1])
-        },
-        os.path.basename(control[0]): {
-            'result_type': 'merged_cells_bam', 'filtering': 'control',
-            'auxiliary': helpers.get_auxiliary_files(control[0])
-        },
-        os.path.basename(control[1]): {
-            'result_type': 'merged_cells_bam', 'filtering': 'control',
-            'auxiliary': helpers.get_auxiliary_files(control[1])
-        },
-        os.path.basename(contaminated[0]): {
-            'result_type': 'merged_cells_bam', 'filtering': 'contaminated',
-            'auxiliary': helpers.get_auxiliary_files(contaminated[0])
-        },
-        os.path.basename(contaminated[1]): {
-            'result_type': 'merged_cells_bam', 'filtering': 'contaminated',
-            'auxiliary': helpers.get_auxiliary_files(contaminated[1])
-        },
-        os.path.basename(tarfile): {
-            'result_type': 'alignment_metrics_plots',
-            'auxiliary': helpers.get_auxiliary_files(tarfile)
-        }
+        os.path.basename(filepath): dict(info, auxiliary=helpers.get_auxiliary_files(filepath))
+        for filepath, info in files
     }
 
     data['meta'] = {
@@ -330,7 +346,7 @@ def generate_metadata(
     }
 
     with open(metadata_output, 'wt') as writer:
-        yaml.dump(data, writer, default_flow_style=False)
+        yaml.dump(data, writer, default_flow_style=False, Dumper=YamlDumper)
 
 
 def supplementary_reference_cmdline(jsonfile):
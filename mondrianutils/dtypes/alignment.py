@@ -1,4 +1,8 @@
-def dtypes(fastqscreen_genomes=['grch37', 'mm10', 'salmon']):
+import functools
+
+
+@functools.lru_cache(maxsize=None)
+def _dtypes(fastqscreen_genomes):
     metrics = {
         'cell_id': 'category',
         'total_mapped_reads': 'int',
@@ -64,7 +68,13 @@ def dtypes(fastqscreen_genomes=['grch37', 'mm10', 'salmon']):
     for genome in fastqscreen_genomes:
         fastqscreen_detailed[genome] = 'int'
 
+    return {
+        'metrics': metrics,
+        'gc': gc,
+        'fastqscreen_detailed': fastqscreen_detailed
+    }
 
-    dtypes = locals()
 
-    return dtypes
+def dtypes(fastqscreen_genomes=('grch37', 'mm10', 'salmon')):
+    # return copies so callers can't modify the cached dicts
+    return {k: dict(v) for k, v in _dtypes(tuple(fastqscreen_genomes)).items()}
@@ -180,7 +180,7 @@ def get_merge_command(bams, output, ncores=1):
     if len(bams) == 1:
         command = ['cp', bams[0], output]
     else:
-        command = ['sambamba', 'merge', '-t', str(ncores), output]
+        command = ['samtools', 'merge', '-@', str(ncores), '-c', '-p', output]
         command.extend(bams)
 
     return command
@@ -248,16 +248,7 @@ def metadata_helper(files_json, metadata_yamls, samples, wf_type):
 
 
 def get_auxiliary_files(filepath):
-    if filepath.endswith('.yaml'):
-        return True
-    elif filepath.endswith('.csi'):
-        return True
-    elif filepath.endswith('.tbi'):
-        return True
-    elif filepath.endswith('.bai'):
-        return True
-    else:
-        return False
+    return filepath.endswith(('.yaml', '.csi', '.tbi', '.bai'))
 
 
 def run_cmd(cmd, output=None):
@@ -24,8 +24,9 @@ def split_interval(interval, num_splits):
 @cli.command()
 @click.option('--inputs', multiple=True, help='vcf files to merge')
 @click.option('--output', help='merged output vcf')
-def merge_vcf_files(inputs, output):
-    mondrianutils.variant_calling.merge_vcf_files(inputs, output)
+@click.option('--dedupe', is_flag=True, help='skip records with a chrom, pos, ref and alt already written')
+def merge_vcf_files(inputs, output, dedupe):
+    mondrianutils.variant_calling.merge_vcf_files(inputs, output, dedupe=dedupe)
 
 
 @cli.command()
@@ -1,6 +1,15 @@
-import os
+import contextlib
+import functools
 import gzip
 import json
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import math
 import numpy as np
@@ -10,6 +19,46 @@ import yaml
 from mondrianutils import helpers
 from mondrianutils import __version__
 
+COPY_BUFSIZE = 1 << 20
+
+WORKFLOW_TYPE_PRECEDENCE = [
+    ('consensus_maf', 'variant_calling'),
+    ('sample_consensus_vcf', 'variant_consensus'),
+    ('mutect_vcf', 'variant_mutect'),
+    ('museq_vcf', 'variant_museq'),
+    ('strelka_indel', 'variant_strelka'),
+]
+
+
+@contextlib.contextmanager
+def _open_gz_write(filepath):
+    # gzip writes are cpu bound, use fast compression and pigz when available
+    if shutil.which('pigz') is None:
+        with gzip.open(filepath, 'wb', compresslevel=1) as writer:
+            yield writer
+        return
+
+    with open(filepath, 'wb') as output:
+        proc = subprocess.Popen(['pigz', '-1', '-c'], stdin=subprocess.PIPE, stdout=output)
+        writer = proc.stdin
+        try:
+            yield writer
+        finally:
+            try:
+                writer.close()
+            finally:
+                retcode = proc.wait()
+
+    if retcode:
+        raise Exception('pigz failed with exit code {} writing {}'.format(retcode, filepath))
+
+
+def _open_write(filepath):
+    if filepath.endswith('.gz'):
+        return _open_gz_write(filepath)
+    return open(filepath, 'wb')
+
+
 def get_header(infile):
     with helpers.getFileHandle(infile, 'rt') as reader:
         header = []
@@ -21,42 +70,143 @@ def get_header(infile):
         return header
 
 
-def merge_vcf_files(infiles, outfile):
+def _skip_vcf_header(reader):
+    for line in reader:
+        if not line.startswith(b'#'):
+            return line
+    return b''
+
+
+def _skip_maf_header(reader):
+    header1 = reader.readline()
+    if not header1:
+        # empty maf, nothing to copy
+        return b''
+
+    header2 = reader.readline()
+    assert header1.startswith(b'#version')
+    assert header2.startswith(b'Hugo_Symbol')
+    return b''
+
+
+def _skip_csv_header(reader):
+    line = reader.readline()
+    return b'' if line.startswith(b'chrom') else line
+
+
+def _put_chunk(chunks, chunk, cancelled):
+    while not cancelled.is_set():
+        try:
+            chunks.put(chunk, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _read_body_chunks(infile, skip_header, chunks, cancelled):
+    try:
+        with helpers.getFileHandle(infile, 'rb') as reader:
+            chunk = skip_header(reader)
+            if chunk and not _put_chunk(chunks, chunk, cancelled):
+                return
+
+            for chunk in iter(lambda: reader.read(COPY_BUFSIZE), b''):
+                if not _put_chunk(chunks, chunk, cancelled):
+                    return
+    except Exception as exc:
+        _put_chunk(chunks, exc, cancelled)
+        return
+
+    _put_chunk(chunks, None, cancelled)
+
+
+def _concatenate_bodies(infiles, writer, skip_header, max_workers=8):
+    '''
+    read and decompress the inputs in parallel, write them out in input order
+    '''
+    cancelled = threading.Event()
+    queues = [queue.Queue(maxsize=16) for _ in infiles]
+
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(infiles)))
+    for infile, chunks in zip(infiles, queues):
+        executor.submit(_read_body_chunks, infile, skip_header, chunks, cancelled)
+
+    try:
+        for chunks in queues:
+            for chunk in iter(chunks.get, None):
+                if isinstance(chunk, Exception):
+                    raise chunk
+                writer.write(chunk)
+    except BaseException:
+        # stop the running readers and drop the ones that haven't started
+        cancelled.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+
+    executor.shutdown()
+
+
+def _write_unique_vcf_records(infiles, writer):
+    seen = set()
+    for infile in infiles:
+        with helpers.getFileHandle(infile, 'rb') as reader:
+            for line in reader:
+                if line.startswith(b'#'):
+                    continue
+                # chrom, pos, ref and alt
+                fields = line.split(b'\t', 5)
+                key = b'\t'.join(fields[:2] + fields[3:5])
+                if key in seen:
+                    continue
+                seen.add(key)
+                writer.write(line)
+
+
+def merge_vcf_files(infiles, outfile, dedupe=False):
     assert len(infiles) >= 1
-    with helpers.getFileHandle(outfile, 'wt') as writer:
+    with _open_write(outfile) as writer:
         header = get_header(infiles[0])
         for line in header:
-            writer.write(line)
+            writer.write(line.encode())
 
-        for infile in infiles:
-            with helpers.getFileHandle(infile, 'rt') as reader:
-                for line in reader:
-                    if line.startswith('#'):
-                        continue
-                    writer.write(line)
+        if dedupe:
+            _write_unique_vcf_records(infiles, writer)
+        else:
+            _concatenate_bodies(infiles, writer, _skip_vcf_header)
 
 
-def generate_intervals(ref, chromosomes, size=1000000):
-    if ref.endswith('.fai'):
-        lengths = []
-        names = []
-        with open(ref, 'rt') as reader:
-            for line in reader:
-                line = line.strip().split()
-                names.append(line[0])
-                lengths.append(int(line[1]))
-    else:
+def _read_fai(ref):
+    fai = ref if ref.endswith('.fai') else ref + '.fai'
+
+    if not os.path.exists(fai):
         fasta = pysam.FastaFile(ref)
-        lengths = fasta.lengths
-        names = fasta.references
+        return fasta.references, fasta.lengths
 
+    lengths = []
+    names = []
+    with open(fai, 'rt') as reader:
+        for line in reader:
+            line = line.strip().split()
+            names.append(line[0])
+            lengths.append(int(line[1]))
+    return names, lengths
+
+
+def generate_intervals(ref, chromosomes, size=1000000):
+    names, lengths = _read_fai(ref)
+    chromosomes = frozenset(chromosomes)
+    size = int(size)
+
+    intervals = []
     for name, length in zip(names, lengths):
         if name not in chromosomes:
             continue
-        for i in range(int((length / size) + 1)):
-            start = str(int(i * size) + 1)
-            end = str(min(int((i + 1) * size), length))
-            print(name + ":" + start + "-" + end)
+        starts = np.arange(1, length + 1, size, dtype=np.int64)
+        ends = np.minimum(starts + size - 1, length)
+        intervals.extend('{}:{}-{}'.format(name, start, end) for start, end in zip(starts.tolist(), ends.tolist()))
+
+    sys.stdout.write(''.join(v + '\n' for v in intervals))
 
 
 def split_interval(interval, num_splits):
@@ -82,14 +232,12 @@ def split_interval(interval, num_splits):
         else:
             intervals.append('{}:{}-{}'.format(chrom, interval_start, interval_end))
 
-    for interval in intervals:
-        print(interval)
+    sys.stdout.write(''.join(v + '\n' for v in intervals))
 
 
 def get_genome_size(ref, chromosomes):
-    fasta = pysam.FastaFile(ref)
-    lengths = fasta.lengths
-    names = fasta.references
+    names, lengths = _read_fai(ref)
+    chromosomes = frozenset(chromosomes)
 
     genome_size = 0
     for name, length in zip(names, lengths):
@@ -101,7 +249,8 @@ def get_genome_size(ref, chromosomes):
 
 
 def merge_chromosome_depths_strelka(infiles, outfile):
-    data = {}
+    # chrom -> [sum of depths, number of files]
+    data = defaultdict(lambda: [0.0, 0])
 
     if isinstance(infiles, dict):
         infiles = infiles.values()
@@ -110,32 +259,21 @@ def merge_chromosome_depths_strelka(infiles, outfile):
         with open(infile) as indata:
             depthdata = indata.readline()
             chrom, depth = depthdata.strip().split()
-            if chrom not in data:
-                data[chrom] = []
-            data[chrom].append(float(depth))
+            data[chrom][0] += float(depth)
+            data[chrom][1] += 1
 
     with open(outfile, 'w') as output:
-        for chrom, depths in data.items():
-            output.write('{}\t{}\n'.format(chrom, np.mean(depths)))
+        output.writelines('{}\t{}\n'.format(chrom, total / count) for chrom, (total, count) in data.items())
 
 
 def get_sample_id_bam(bamfile):
-    bam = pysam.AlignmentFile(bamfile)
-    readgroups = bam.header['RG']
-
-    samples = set()
-
-    for readgroup in readgroups:
-        samples.add(readgroup['SM'])
-
-    assert len(samples) == 1
-
-    print(list(samples)[0])
+    print(_get_sample_id(bamfile))
 
 
+@functools.lru_cache(maxsize=None)
 def _get_sample_id(bamfile):
-    bam = pysam.AlignmentFile(bamfile)
-    readgroups = bam.header['RG']
+    with pysam.AlignmentFile(bamfile, 'rb', check_sq=False) as bam:
+        readgroups = bam.header['RG']
 
     samples = set()
 
@@ -152,47 +290,55 @@ def vcf_reheader_id(infile, outfile, tumour_bam, normal_bam, vcf_normal_id, vcf_
     normal_id = _get_sample_id(normal_bam)
 
     in_opener = gzip.open if '.gz' in infile else open
-    out_opener = gzip.open if '.gz' in outfile else open
 
-    with in_opener(infile, 'rt') as indata:
-        with out_opener(outfile, 'wt') as outdata:
+    sample_lines = '##tumor_sample={}\n##normal_sample={}\n'.format(tumour_id, normal_id).encode()
+    old_tumour_id, new_tumour_id = vcf_tumour_id.encode(), tumour_id.encode()
+    old_normal_id, new_normal_id = vcf_normal_id.encode(), normal_id.encode()
+
+    with in_opener(infile, 'rb') as indata:
+        with _open_write(outfile) as outdata:
             for line in indata:
-                if line.startswith('#CHROM'):
-                    outdata.write('##tumor_sample={}\n'.format(tumour_id))
-                    outdata.write('##normal_sample={}\n'.format(normal_id))
-                    line = line.replace(vcf_tumour_id, tumour_id).replace(vcf_normal_id, normal_id)
-                    outdata.write(line)
-                else:
+                if line.startswith(b'#CHROM'):
+                    outdata.write(sample_lines)
+                    line = line.replace(old_tumour_id, new_tumour_id).replace(old_normal_id, new_normal_id)
                     outdata.write(line)
+                    break
+                outdata.write(line)
+
+            # #CHROM is the last header line, records are copied as is
+            shutil.copyfileobj(indata, outdata, COPY_BUFSIZE)
 
 
 def update_maf_ids(infile, output, tumour_bam, normal_bam):
     normal_id = helpers.get_sample_from_bam(normal_bam)
     tumour_id = helpers.get_sample_from_bam(tumour_bam)
 
-    with open(infile) as infile_read:
-        maf_header = infile_read.readline()
-    assert maf_header.startswith('#version 2.4')
+    # for germlines tumour will be none
+    if tumour_id is None:
+        tumour_id = 'NA'
 
-    df = pd.read_csv(infile, skiprows=1, sep='\t')
+    with open(infile, 'rt') as reader, open(output, 'wt') as writer:
+        maf_header = reader.readline()
+        assert maf_header.startswith('#version 2.4')
+        writer.write(maf_header)
 
-    assert len(df['Tumor_Sample_Barcode'].unique()) == 1
-    assert df['Tumor_Sample_Barcode'].unique()[0] == 'TUMOR'
+        header = reader.readline()
+        writer.write(header)
 
-    assert len(df['Matched_Norm_Sample_Barcode'].unique()) == 1
-    assert df['Matched_Norm_Sample_Barcode'].unique()[0] == 'NORMAL'
+        header = {v: i for i, v in enumerate(header.rstrip('\n').split('\t'))}
+        tumour_idx = header['Tumor_Sample_Barcode']
+        normal_idx = header['Matched_Norm_Sample_Barcode']
 
-    df['Matched_Norm_Sample_Barcode'] = normal_id
+        for line in reader:
+            line = line.rstrip('\n').split('\t')
 
-    # for germlines tumour will be none
-    if tumour_id is None:
-        tumour_id = 'NA'
-    df['Tumor_Sample_Barcode'] = tumour_id
+            assert line[tumour_idx] == 'TUMOR'
+            assert line[normal_idx] == 'NORMAL'
 
-    with open(output, 'wt') as outfile:
-        outfile.write(maf_header)
+            line[tumour_idx] = tumour_id
+            line[normal_idx] = normal_id
 
-        df.to_csv(outfile, sep='\t', index=False)
+            writer.write('\t'.join(line) + '\n')
 
 
 def merge_mafs(infiles, output):
@@ -204,25 +350,22 @@ def merge_mafs(infiles, output):
         assert header1.startswith('#version')
         assert header2.startswith('Hugo_Symbol')
 
-    with helpers.getFileHandle(output, 'wt') as writer:
-        writer.write(header1)
-        writer.write(header2)
+    with helpers.getFileHandle(output, 'wb') as writer:
+        writer.write(header1.encode())
+        writer.write(header2.encode())
 
-        for infile in infiles:
-            with helpers.getFileHandle(infile, 'rt') as reader:
-                for line in reader:
-                    if line.startswith('#version') or line.startswith('Hugo_Symbol'):
-                        continue
-                    writer.write(line)
+        _concatenate_bodies(infiles, writer, _skip_maf_header)
 
 
 def update_maf_counts(input_maf, counts_file, output_maf):
-    counts = {}
-    with open(counts_file) as infile:
-        for line in infile:
-            line = line.strip().split()
-            chrom, pos, id, ta, tr, td, na, nr, nd = line
-            counts[(chrom, pos, id)] = (ta, tr, td, na, nr, nd)
+    counts = pd.read_csv(
+        counts_file, sep=r'\s+', header=None, names=['chrom', 'pos', 'id', 'ta', 'tr', 'td', 'na', 'nr', 'nd'],
+        dtype=str, keep_default_na=False, engine='c'
+    )
+    counts = dict(zip(
+        zip(counts['chrom'], counts['pos'], counts['id']),
+        zip(counts['ta'], counts['tr'], counts['td'], counts['na'], counts['nr'], counts['nd'])
+    ))
 
     with open(input_maf) as infile, open(output_maf, 'wt') as outfile:
         header = infile.readline()
@@ -244,65 +387,67 @@ def update_maf_counts(input_maf, counts_file, output_maf):
         pos = header['vcf_pos']
         vcfid = header['vcf_id']
 
+        # only split as far as the key columns, rows without counts are copied as is
+        maxsplit = max(chrom, pos, vcfid) + 1
+
         for line in infile:
-            line_split = line.strip().split('\t')
+            # vcf_pos is usually the last maf column, drop the newline before the lookup
+            key_split = line.rstrip('\r\n').split('\t', maxsplit)
+            key = (key_split[chrom], key_split[pos], key_split[vcfid])
+
+            if key not in counts:
+                outfile.write(line)
+                continue
 
-            if (line_split[chrom], line_split[pos], line_split[vcfid]) in counts:
-                ta, tr, td, na, nr, nd = counts[(line_split[chrom], line_split[pos], line_split[vcfid])]
+            ta, tr, td, na, nr, nd = counts[key]
 
-                line_split[t_dp] = td
-                line_split[t_ref] = tr
-                line_split[t_alt] = ta
+            line_split = line.strip().split('\t')
 
-                line_split[n_dp] = nd
-                line_split[n_ref] = nr
-                line_split[n_alt] = na
+            line_split[t_dp] = td
+            line_split[t_ref] = tr
+            line_split[t_alt] = ta
 
-                line = '\t'.join(line_split) + '\n'
+            line_split[n_dp] = nd
+            line_split[n_ref] = nr
+            line_split[n_alt] = na
 
-            outfile.write(line)
+            outfile.write('\t'.join(line_split) + '\n')
 
 
 def concatenate_csv(inputs, output):
-    header = open(inputs[0]).readline()
+    with open(inputs[0], 'rb') as infile:
+        header = infile.readline()
 
-    with open(output, 'wt') as outfile:
+    with open(output, 'wb') as outfile:
         outfile.write(header)
-        for inputfile in inputs:
-            with open(inputfile, 'rt') as infile:
-                for line in infile:
-                    if line.startswith('chrom'):
-                        continue
-                    outfile.write(line)
+        _concatenate_bodies(inputs, outfile, _skip_csv_header)
 
 
 def fix_museq_vcf(infile, output):
-    with open(infile, 'rt') as reader, open(output, 'wt') as writer:
+    with open(infile, 'rb') as reader, open(output, 'wb') as writer:
         for line in reader:
-            if line.startswith('#'):
-                line = line.replace('##FORMAT=<ID=PL,Number=3', '##FORMAT=<ID=PL,Number=G')
+            if not line.startswith(b'#'):
+                writer.write(line)
+                break
+            line = line.replace(b'##FORMAT=<ID=PL,Number=3', b'##FORMAT=<ID=PL,Number=G')
             writer.write(line)
 
+        # only the header is modified
+        shutil.copyfileobj(reader, writer, COPY_BUFSIZE)
+
 
 def infer_type(files):
     with open(files, 'rt') as reader:
         files = json.load(reader)
 
-    filetypes = sorted(set([v['left'] for v in files]))
-
-    # more than one wf
-    if 'consensus_maf' in filetypes:
-        return 'variant_calling'
-    elif 'sample_consensus_vcf' in filetypes:
-        return 'variant_consensus'
-    elif 'mutect_vcf' in filetypes:
-        return 'variant_mutect'
-    elif 'museq_vcf' in filetypes:
-        return 'variant_museq'
-    elif 'strelka_indel' in filetypes:
-        return 'variant_strelka'
-    else:
-        raise Exception()
+    filetypes = {v['left'] for v in files}
+
+    # more than one wf, first match wins
+    for filetype, wf_type in WORKFLOW_TYPE_PRECEDENCE:
+        if filetype in filetypes:
+            return wf_type
+
+    raise Exception()
 
 
 def generate_metadata(
@@ -0,0 +1,136 @@
+import os
+import threading
+
+import pytest
+
+import mondrianutils.variant_calling.utils as utils
+
+
+def write_vcf(vcf_path, records):
+    with open(vcf_path, 'wt') as writer:
+        writer.write('##fileformat=VCFv4.2\n')
+        writer.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        for chrom, pos, ref, alt in records:
+            writer.write(f'{chrom}\t{pos}\t.\t{ref}\t{alt}\t.\tPASS\t.\n')
+
+
+def read_records(vcf_path):
+    with open(vcf_path, 'rt') as reader:
+        return [line.split('\t')[:5] for line in reader if not line.startswith('#')]
+
+
+def test_concatenate_bodies_keeps_input_order(tmpdir, monkeypatch):
+    # small reads so every input is split over several chunks
+    monkeypatch.setattr(utils, 'COPY_BUFSIZE', 7)
+
+    infiles = []
+    for i in range(20):
+        vcf_path = os.path.join(tmpdir, f'{i}.vcf')
+        write_vcf(vcf_path, [('1', i * 10 + j, 'A', 'T') for j in range(5)])
+        infiles.append(vcf_path)
+
+    output = os.path.join(tmpdir, 'merged.vcf')
+    with open(output, 'wb') as writer:
+        utils._concatenate_bodies(infiles, writer, utils._skip_vcf_header, max_workers=3)
+
+    positions = [int(record[1]) for record in read_records(output)]
+    assert positions == [i * 10 + j for i in range(20) for j in range(5)]
+
+
+def test_concatenate_bodies_raises_reader_error(tmpdir):
+    infiles = [os.path.join(tmpdir, f'{i}.vcf') for i in range(4)]
+    for vcf_path in infiles[:2]:
+        write_vcf(vcf_path, [('1', 100, 'A', 'T')])
+
+    output = os.path.join(tmpdir, 'merged.vcf')
+    with open(output, 'wb') as writer:
+        with pytest.raises(FileNotFoundError):
+            utils._concatenate_bodies(infiles, writer, utils._skip_vcf_header, max_workers=2)
+
+
+def test_concatenate_bodies_writer_error_does_not_hang(tmpdir, monkeypatch):
+    monkeypatch.setattr(utils, 'COPY_BUFSIZE', 7)
+
+    infiles = []
+    for i in range(10):
+        vcf_path = os.path.join(tmpdir, f'{i}.vcf')
+        write_vcf(vcf_path, [('1', j, 'A', 'T') for j in range(100)])
+        infiles.append(vcf_path)
+
+    class FailingWriter(object):
+        def write(self, data):
+            raise IOError('disk full')
+
+    errors = []
+
+    def concatenate():
+        try:
+            utils._concatenate_bodies(infiles, FailingWriter(), utils._skip_vcf_header, max_workers=3)
+        except IOError as exc:
+            errors.append(exc)
+
+    thread = threading.Thread(target=concatenate, daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+
+    assert not thread.is_alive()
+    assert len(errors) == 1
+
+
+def test_merge_vcf_files_dedupe(tmpdir):
+    shard_1 = os.path.join(tmpdir, 'shard_1.vcf')
+    write_vcf(shard_1, [('1', 100, 'A', 'T'), ('1', 200, 'C', 'G')])
+
+    # overlaps shard_1 at 1:200, with a second alt allele at the same position
+    shard_2 = os.path.join(tmpdir, 'shard_2.vcf')
+    write_vcf(shard_2, [('1', 200, 'C', 'G'), ('1', 200, 'C', 'A'), ('1', 300, 'G', 'T')])
+
+    output = os.path.join(tmpdir, 'merged.vcf')
+    utils.merge_vcf_files([shard_1, shard_2], output, dedupe=True)
+
+    assert read_records(output) == [
+        ['1', '100', '.', 'A', 'T'],
+        ['1', '200', '.', 'C', 'G'],
+        ['1', '200', '.', 'C', 'A'],
+        ['1', '300', '.', 'G', 'T'],
+    ]
+
+
+def write_maf(maf_path, columns, rows):
+    with open(maf_path, 'wt') as writer:
+        writer.write('#version 2.4\n')
+        writer.write('\t'.join(columns) + '\n')
+        for row in rows:
+            writer.write('\t'.join(row) + '\n')
+
+
+def read_maf(maf_path):
+    with open(maf_path, 'rt') as reader:
+        lines = reader.readlines()
+    columns = lines[1].rstrip('\n').split('\t')
+    return [dict(zip(columns, line.rstrip('\n').split('\t'))) for line in lines[2:]]
+
+
+def test_update_maf_counts_vcf_pos_last(tmpdir):
+    columns = [
+        'Hugo_Symbol', 'Chromosome', 't_depth', 't_ref_count', 't_alt_count',
+        'n_depth', 'n_ref_count', 'n_alt_count', 'vcf_id', 'vcf_pos'
+    ]
+    maf = os.path.join(tmpdir, 'input.maf')
+    write_maf(maf, columns, [
+        ['GENE1', '1', '0', '0', '0', '0', '0', '0', '.', '100'],
+        ['GENE2', '1', '0', '0', '0', '0', '0', '0', '.', '200'],
+    ])
+
+    counts = os.path.join(tmpdir, 'counts.txt')
+    with open(counts, 'wt') as writer:
+        writer.write('1 100 . 6 5 11 8 7 15\n')
+
+    output = os.path.join(tmpdir, 'output.maf')
+    utils.update_maf_counts(maf, counts, output)
+
+    updated, unchanged = read_maf(output)
+    assert [updated[col] for col in ['t_depth', 't_ref_count', 't_alt_count']] == ['11', '6', '5']
+    assert [updated[col] for col in ['n_depth', 'n_ref_count', 'n_alt_count']] == ['15', '8', '7']
+    assert updated['vcf_pos'] == '100'
+    assert [unchanged[col] for col in columns[2:8]] == ['0'] * 6